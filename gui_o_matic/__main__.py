@@ -7,4 +7,10 @@
 import sys
 from gui_o_matic.control import GUIPipeControl
 
-GUIPipeControl(sys.stdin).bootstrap()
+
+def main():
+    GUIPipeControl(sys.stdin).bootstrap()
+
+
+if __name__ == '__main__':
+    main()
@@ -6,40 +6,98 @@
 
 import json
 import os
-import pathlib
+import re
+import selectors
 import socket
 import subprocess
-import sys
 import threading
 import time
 import traceback
 from urllib import request
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-target_path = pathlib.Path(os.path.abspath(__file__)).parents[3]
-sys.path.append(target_path)
-from gui.auto import AutoGUI
+from gui_o_matic.gui.auto import AutoGUI
+
+# Command arguments are parsed straight from bytes; orjson is much faster
+# at this if it is installed.
+_loads = orjson.loads if orjson is not None else json.loads
+
+# JSON strings cannot contain raw newlines, so nesting can be tracked per line
+_JSON_NESTING = re.compile(rb'"(?:[^"\\]|\\.)*"|[\[\]{}]')
+
+
+def _json_depth(line, depth=0):
+    '''
+    Update a JSON nesting depth with the brackets found in a line.
+    '''
+    for token in _JSON_NESTING.findall(line):
+        if token in (b'{', b'['):
+            depth += 1
+        elif token in (b'}', b']'):
+            depth -= 1
+    return depth
 
 
 class GUIPipeControl(threading.Thread):
+    # Read commands in large blocks; drivers tend to stream many short lines.
+    READ_BUFSIZE = 1024 * 1024
+
     OK_GO = 'OK GO'
     OK_LISTEN = 'OK LISTEN'
     OK_LISTEN_TO = 'OK LISTEN TO:'
     OK_LISTEN_TCP = 'OK LISTEN TCP:'
     OK_LISTEN_HTTP = 'OK LISTEN HTTP:'
 
+    # The "Ongoing GUI Updates" methods from PROTOCOL.md; nothing else on
+    # the GUI object may be invoked by the driver.
+    COMMANDS = (
+        'show_splash_screen',
+        'update_splash_screen',
+        'hide_splash_screen',
+        'show_main_window',
+        'hide_main_window',
+        'set_status',
+        'set_status_display',
+        'set_item',
+        'set_next_error_message',
+        'notify_user',
+        'show_url',
+        'terminal',
+        'set_http_cookie',
+        'quit')
+
     def __init__(self, fd, config=None, gui_object=None):
         threading.Thread.__init__(self)
         self.daemon = True
         self.config = config
         self.gui = gui_object
         self.sock = None
-        self.fd = fd
+        # Commands are parsed as bytes; unwrap text streams such as sys.stdin
+        self.fd = getattr(fd, 'buffer', fd)
         self.child = None
         self.listening = None
+        self._dispatch = self._build_dispatch() if gui_object else {}
+        self._stopping = False
+        self._shutdown_lock = threading.Lock()
+        if os.name != 'nt':
+            # Only the selectors loop in _read_lines() watches this pipe
+            self._shutdown_r, self._shutdown_w = os.pipe()
+            os.set_blocking(self._shutdown_r, False)
+            os.set_blocking(self._shutdown_w, False)
+        else:
+            self._shutdown_r = self._shutdown_w = None
+
+    def _build_dispatch(self):
+        return dict((name, getattr(self.gui, name))
+                    for name in self.COMMANDS if hasattr(self.gui, name))
 
     def shell_pivot(self, command):
         self.child = subprocess.Popen(command, shell=True, close_fds=(os.name != 'nt'),  # Doesn't work on windows!
-                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                      bufsize=self.READ_BUFSIZE)
         self.fd = self.child.stdout
 
     def _listen(self):
@@ -48,22 +106,39 @@ class GUIPipeControl(threading.Thread):
         self.listening.listen(0)
         return str(self.listening.getsockname()[1])
 
+    def _wait_for_child(self, timeout=60):
+        # Wait for either the child to connect or its stdout to hit EOF,
+        # whichever comes first. Windows can only select() on sockets.
+        sel = selectors.DefaultSelector()
+        sel.register(self.listening, selectors.EVENT_READ)
+        if os.name != 'nt':
+            sel.register(self.child.stdout, selectors.EVENT_READ)
+        deadline = time.monotonic() + timeout
+        try:
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('Timed out waiting for child')
+                for key, _ in sel.select(timeout=remaining):
+                    if key.fileobj is self.listening:
+                        return
+                    # Nobody else reads the child's stdout in TCP mode, so
+                    # discard any chatter; EOF means the child went away.
+                    if not os.read(self.child.stdout.fileno(), 4096):
+                        raise IOError('Child exited before connecting')
+        finally:
+            sel.close()
+
     def _accept(self):
         if self.child is not None:
-            self.listening.settimeout(1)
-            for _ in range(0, 60):
-                try:
-                    self.sock = self.listening.accept()[0]
-                    break
-                except socket.timeout:
-                    pass
+            self._wait_for_child(60)
         else:
             self.listening.settimeout(60)
-            self.sock = self.listening.accept()[0]
+        self.sock = self.listening.accept()[0]
 
         # https://stackoverflow.com/questions/19570672/non-blocking-error-when-adding-timeout-to-python-server
         self.sock.setblocking(True)
-        self.fd = self.sock.makefile()
+        self.fd = self.sock.makefile('rb', buffering=self.READ_BUFSIZE)
 
     def shell_tcp_pivot(self, command):
         port = self._listen()
@@ -97,72 +172,200 @@ class GUIPipeControl(threading.Thread):
         except Exception as e:
             if self.gui:
                 self.gui._report_error(e)
-                time.sleep(30)
             else:
                 traceback.print_exc()
+            return True, listen
 
     def bootstrap(self, dry_run=False):
         assert (self.config is None)
         assert (self.gui is None)
 
         listen = False
-        config = []
+        config = None
+        depth = 0
+        buf = bytearray()
         while True:
             line = self.fd.readline()
 
-            match, listen = self.do_line_magic(line, listen)
+            if not line or line.startswith(b'OK '):
+                match, listen = self.do_line_magic(line.decode('utf-8'), listen)
+            else:
+                match = False
             if match:
                 break
-            else:
-                config.append(line.strip())
+            elif config is None:
+                # Decode as soon as the top-level value is complete
+                buf += line
+                depth = _json_depth(line, depth)
+                if depth == 0 and line.strip():
+                    config = json.loads(buf)
+                    buf = None
+            elif line.strip():
+                raise ValueError('Unexpected data after config: %r' % line)
 
-        self.config = json.loads(''.join(config))
+        self.config = config if config is not None else json.loads(buf)
         self.gui = AutoGUI(self.config)
+        self._dispatch = self._build_dispatch()
         if not dry_run:
             if listen:
                 self.start()
-            self.gui.run()
+            try:
+                self.gui.run()
+            finally:
+                # The GUI is gone; stop the reader so it puts the command
+                # fd back the way it found it. The reader closes the pipe
+                # itself, it may still be using it if the join times out.
+                self.quit()
+                if listen:
+                    self.join(0.5)
+                else:
+                    self._close_shutdown_pipe()
 
     def do(self, command, kwargs):
-        if hasattr(self.gui, command):
-            getattr(self.gui, command)(**kwargs)
+        fn = self._dispatch.get(command)
+        if fn is not None:
+            fn(**kwargs)
         else:
             print(('Unknown method: %s' % command))
 
-    def run(self):
+    def quit(self):
+        '''
+        Wake up the command loop and make it stop reading commands.
+        '''
+        self._stopping = True
+        with self._shutdown_lock:
+            if self._shutdown_w is not None:
+                try:
+                    os.write(self._shutdown_w, b'\0')
+                except BlockingIOError:
+                    pass  # A wakeup is already pending
+
+    def _close_shutdown_pipe(self):
+        with self._shutdown_lock:
+            for pipe_fd in (self._shutdown_r, self._shutdown_w):
+                if pipe_fd is not None:
+                    os.close(pipe_fd)
+            self._shutdown_r = self._shutdown_w = None
+
+    def _read_lines(self):
+        '''
+        Yield command lines from self.fd until EOF or quit(), following
+        self.fd when a pivot replaces it.
+        '''
+        if os.name == 'nt':
+            # Windows can only select() on sockets, so just block.
+            yield from self._blocking_read_lines()
+            return
+
+        sel = selectors.DefaultSelector()
+        sel.register(self._shutdown_r, selectors.EVENT_READ)
+        fd = None
+        was_blocking = True
         try:
-            while not self.gui.ready:
-                time.sleep(0.1)
-            time.sleep(0.1)
             while True:
+                if fd is not self.fd:
+                    if fd is not None:
+                        sel.unregister(fd)
+                        self._restore_blocking(fd, was_blocking)
+                    fd = self.fd
+                    was_blocking = os.get_blocking(fd.fileno())
+                    try:
+                        sel.register(fd, selectors.EVENT_READ)
+                    except OSError:
+                        # epoll refuses regular files, e.g. stdin redirected
+                        # from a script. Reading those never blocks anyway.
+                        break
+                    # Non-blocking, read1() first drains whatever is already
+                    # buffered and then returns b'' instead of blocking.
+                    os.set_blocking(fd.fileno(), False)
+                    pending = bytearray()
+                    waited = False
+
                 try:
-                    line = self.fd.readline()
-                except IOError as e:
-                    line = None
+                    data = fd.read1(self.READ_BUFSIZE)
+                except IOError:
+                    return
+                if data:
+                    waited = False
+                    pending += data
+                    while fd is self.fd:
+                        eol = pending.find(b'\n') + 1
+                        if not eol:
+                            break
+                        line = bytes(pending[:eol])
+                        del pending[:eol]
+                        yield line
+                elif waited:
+                    # Readable but empty: EOF
+                    if pending:
+                        yield bytes(pending)
+                    return
+                else:
+                    for key, _ in sel.select():
+                        if key.fileobj == self._shutdown_r:
+                            return
+                    waited = True
+        finally:
+            sel.close()
+            if fd is not None:
+                self._restore_blocking(fd, was_blocking)
 
-                if not line:
+        yield from self._blocking_read_lines()
+
+    def _blocking_read_lines(self):
+        while True:
+            try:
+                line = self.fd.readline()
+            except IOError:
+                return
+            if not line:
+                return
+            yield line
+
+    def _restore_blocking(self, fd, blocking):
+        # stdin is usually the caller's tty or pipe, which outlives us
+        try:
+            os.set_blocking(fd.fileno(), blocking)
+        except (OSError, ValueError):
+            pass  # Already closed
+
+    def _process(self, line):
+        cmd, _, args = line.partition(b' ')
+        self.do(cmd.decode('ascii'), _loads(args))
+
+    def run(self):
+        lines = None
+        try:
+            self.gui.ready_event.wait()
+            do_line_magic = self.do_line_magic
+            process = self._process
+            lines = self._read_lines()
+            while True:
+                # The try is only re-entered after a bad line, so the
+                # common path is just read and dispatch.
+                try:
+                    for line in lines:
+                        if not (line.startswith(b'OK ') and do_line_magic(
+                                line.decode('utf-8'), None)[0]):
+                            process(line)
                     break
-                if line:
-                    match, lstn = self.do_line_magic(line, None)
-                    if not match:
-                        try:
-                            cmd, args = line.strip().split(' ', 1)
-                            args = json.loads(args)
-                            self.do(cmd, args)
-                        except (ValueError, IndexError, NameError) as e:
-                            if self.gui:
-                                self.gui._report_error(e)
-                                time.sleep(30)
-                            else:
-                                traceback.print_exc()
+                except (ValueError, IndexError, NameError) as e:
+                    if self.gui:
+                        self.gui._report_error(e)
+                    else:
+                        traceback.print_exc()
 
         except KeyboardInterrupt:
             return
         except:
             traceback.print_exc()
         finally:
-            # Use sys.exit to allow atexit.register() to fire...
-            #
-            self.gui.quit()
-            time.sleep(0.5)
-            os._exit(0)
+            if lines is not None:
+                lines.close()
+            self._close_shutdown_pipe()
+            if not self._stopping:
+                # Use sys.exit to allow atexit.register() to fire...
+                #
+                self.gui.quit()
+                time.sleep(0.5)
+                os._exit(0)
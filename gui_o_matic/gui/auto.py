@@ -39,11 +39,15 @@ def AutoGUI(config, *args, **kwargs):
     """
     Load and instanciate the best GUI available for this machine.
     """
+    errors = []
     for candidate in config.get('_prefer_gui', _known_guis()):
         try:
             impl = importlib.import_module(_gui_libname(candidate))
             return impl.GUI( config, *args, **kwargs )
-        except ImportError:
-            pass
+        except ImportError as e:
+            errors.append('{}: {}'.format(candidate, e))
 
-    raise NotImplementedError("No working GUI found!")
+    raise NotImplementedError(
+        "No working GUI found! The toolkit bindings are optional, install "
+        "them with e.g. pip install 'gui-o-matic[gtk]' (or [macosx], "
+        "[winapi]).\n  " + "\n  ".join(errors))
@@ -26,9 +26,20 @@ class BaseGUI(object):
 
     def __init__(self, config):
         self.config = config
-        self.ready = False
+        self.ready_event = threading.Event()
         self.next_error_message = None
 
+    @property
+    def ready(self):
+        return self.ready_event.is_set()
+
+    @ready.setter
+    def ready(self, value):
+        if value:
+            self.ready_event.set()
+        else:
+            self.ready_event.clear()
+
     def _get_url(self, args, remove=False):
         if isinstance(args, list):
             if remove:
@@ -4,6 +4,7 @@
 #
 # SPDX-License-Identifier: LGPL-3.0-only
 
+import collections
 import pango
 import gobject
 import gtk
@@ -16,10 +17,21 @@ except ImportError:
 
 from gui_o_matic.gui.base import BaseGUI
 
+# Escapes plain text for use in pango markup, in a single pass
+_ESCAPE = str.maketrans({'<': '&lt;', '>': '&gt;', '&': '&amp;'})
+
+# Parsed status display colors, by color spec
+_COLOR_CACHE = {}
+
+
+def _make_activate(do, op, args):
+    return lambda widget: do(op, args)
+
 
 class GtkBaseGUI(BaseGUI):
 
     _HAVE_INDICATOR = False
+    _PIXBUF_CACHE_SIZE = 32
 
     def __init__(self, config):
         BaseGUI.__init__(self, config)
@@ -27,14 +39,53 @@ class GtkBaseGUI(BaseGUI):
         self.font_styles = {}
         self.status_display = {}
         self.popup = None
+        self._last_popup = None
+        self._theme_cache = {}
+        self._pixbuf_cache = collections.OrderedDict()
+        self._gtk_thread = None
+        self._pending = collections.deque()
+        self._pending_displays = {}
+        self._pending_lock = threading.Lock()
+        self._idle_armed = False
         if pynotify:
             pynotify.init(config.get('app_name', 'gui-o-matic'))
         gobject.threads_init()
 
+    def _theme_image(self, path):
+        # Icons and backgrounds get re-themed on every status change
+        themed = self._theme_cache.get(path)
+        if themed is None:
+            themed = BaseGUI._theme_image(self, path)
+            self._theme_cache[path] = themed
+        return themed
+
+    def _enqueue(self, func, *args):
+        # Queue func(*args) for the GTK thread. Bursts of updates share a
+        # single idle callback, which runs them in order.
+        with self._pending_lock:
+            self._pending.append((func, args))
+            if self._idle_armed:
+                return
+            self._idle_armed = True
+        gobject.idle_add(self._drain_pending)
+
+    def _drain_pending(self):
+        with self._pending_lock:
+            pending, self._pending = self._pending, collections.deque()
+            self._idle_armed = False
+        for func, args in pending:
+            try:
+                func(*args)
+            except:
+                traceback.print_exc()
+        return False
+
     def _menu_setup(self):
         self.items = {}
+        self._set_label_fns = {}
         self.menu = gtk.Menu()
         self._create_menu_from_config()
+        self.menu.show_all()
 
     def _add_menu_item(self, id=None, label='Menu item',
                              sensitive=False,
@@ -47,24 +98,27 @@ class GtkBaseGUI(BaseGUI):
             menu_item = gtk.MenuItem(label)
             menu_item.set_sensitive(sensitive)
             if op:
-                def activate(o, a):
-                    return lambda d: self._do(o, a)
-                menu_item.connect("activate", activate(op, args or []))
-        menu_item.show()
+                menu_item.connect("activate",
+                                  _make_activate(self._do, op, args or []))
         self.menu.append(menu_item)
         if id:
             self.items[id] = menu_item
+            self._set_label_fns[id] = menu_item.set_label
 
     def _set_background_image(self, container, image):
         themed_image = self._theme_image(image)
         img = gtk.gdk.pixbuf_new_from_file(themed_image)
+        # Only rescale when the allocation changes, not on every expose
+        scaled = {'size': None, 'pb': None}
         def draw_background(widget, ev):
             alloc = widget.get_allocation()
-            pb = img.scale_simple(alloc.width, alloc.height,
-                                  gtk.gdk.INTERP_BILINEAR)
+            if scaled['size'] != (alloc.width, alloc.height):
+                scaled['pb'] = img.scale_simple(alloc.width, alloc.height,
+                                                gtk.gdk.INTERP_BILINEAR)
+                scaled['size'] = (alloc.width, alloc.height)
             widget.window.draw_pixbuf(
                 widget.style.bg_gc[gtk.STATE_NORMAL],
-                pb, 0, 0, alloc.x, alloc.y)
+                scaled['pb'], 0, 0, alloc.x, alloc.y)
             if (hasattr(widget, 'get_child') and
                     widget.get_child() is not None):
                 widget.propagate_expose(widget.get_child(), ev)
@@ -77,7 +131,13 @@ class GtkBaseGUI(BaseGUI):
                 widget = gtk.Button(label=action.get('label', 'OK'))
                 event = "clicked"
                 if 'buttons' in self.font_styles:
-                    widget.get_child().modify_font(self.font_styles['buttons'])
+                    font = self.font_styles['buttons']
+                    widget.get_child().modify_font(font)
+                    def set_label(label, widget=widget, font=font):
+                        widget.set_label(' %s ' % label)
+                        widget.get_child().modify_font(font)
+                else:
+                    set_label = widget.set_label
 #
 # Disabled for now - what was supposed to happen when the box was ticked
 # or unticked was never really resolved in a satisfactory way.
@@ -100,13 +160,12 @@ class GtkBaseGUI(BaseGUI):
                                           % action['position'])
 
             if action.get('op'):
-                def activate(o, a):
-                    return lambda d: self._do(o, a)
-                widget.connect(event,
-                    activate(action['op'], action.get('args', [])))
+                widget.connect(event, _make_activate(
+                    self._do, action['op'], action.get('args', [])))
 
             widget.set_sensitive(action.get('sensitive', True))
             self.items[action['id']] = widget
+            self._set_label_fns[action['id']] = set_label
 
     def _main_window_indicator(self, menu_container, icon_container):
         if not self._HAVE_INDICATOR:
@@ -120,11 +179,21 @@ class GtkBaseGUI(BaseGUI):
             icon_container.pack_start(icon, False, True)
             self.main_window['indicator_icon'] = icon
 
+    def _scaled_pixbuf(self, icon_path, size):
+        # Status icons flip back and forth, so keep recent ones decoded
+        key = (self._theme_image(icon_path), size)
+        img = self._pixbuf_cache.pop(key, None)
+        if img is None:
+            img = gtk.gdk.pixbuf_new_from_file(key[0])
+            img = img.scale_simple(size, size, gtk.gdk.INTERP_BILINEAR)
+            if len(self._pixbuf_cache) >= self._PIXBUF_CACHE_SIZE:
+                self._pixbuf_cache.popitem(last=False)
+        self._pixbuf_cache[key] = img
+        return img
+
     def _set_status_display_icon(self, status, icon_path, size=32):
         if 'icon' in status:
-            themed_icon = self._theme_image(icon_path)
-            img = gtk.gdk.pixbuf_new_from_file(themed_icon)
-            img = img.scale_simple(size, size, gtk.gdk.INTERP_BILINEAR)
+            img = self._scaled_pixbuf(icon_path, size)
             status['icon'].set_from_pixbuf(img)
             status['icon_size'] = size
 
@@ -158,11 +227,9 @@ class GtkBaseGUI(BaseGUI):
 
             for which in ('title', 'details'):
                 ss[which].set_markup(st.get(which, ''))
-                exact = '%s_%s' % (ss['id'], which)
-                if exact in self.font_styles:
-                    ss[which].modify_font(self.font_styles[exact])
-                elif which in self.font_styles:
-                    ss[which].modify_font(self.font_styles[which])
+                pfd = self._resolved_fonts.get((ss['id'], which))
+                if pfd is not None:
+                    ss[which].modify_font(pfd)
 
             if 'icon' in st:
                 ss['icon'] = gtk.Image()
@@ -244,43 +311,42 @@ class GtkBaseGUI(BaseGUI):
         if _now:
             create(self)
         else:
-            gobject.idle_add(create, self)
+            self._enqueue(create, self)
 
     def quit(self):
         def q(self):
             gtk.main_quit()
-        gobject.idle_add(q, self)
+        self._enqueue(q, self)
 
     def show_main_window(self):
         def show(self):
             if self.main_window:
                 self.main_window['window'].show_all()
-        gobject.idle_add(show, self)
+        self._enqueue(show, self)
 
     def hide_main_window(self):
         def hide(self):
             if self.main_window:
                 self.main_window['window'].hide()
-        gobject.idle_add(hide, self)
+        self._enqueue(hide, self)
 
     def update_splash_screen(self, progress=None, message=None, _now=False):
         def update(self):
             if self.splash:
                 if message is not None and 'message' in self.splash:
                     self.splash['message'].set_markup(
-                        message.replace('<', '&lt;'))
+                        message.translate(_ESCAPE))
                 if progress is not None and 'progress' in self.splash:
                     self.splash['progress'].set_fraction(progress)
         if _now:
             update(self)
         else:
-            gobject.idle_add(update, self)
+            self._enqueue(update, self)
 
     def show_splash_screen(self, height=None, width=None,
                            progress_bar=False, background=None,
                            message=None, message_x=0.5, message_y=0.5,
                            _now=False):
-        wait_lock = threading.Lock()
         def show(self):
             self.hide_splash_screen(_now=True)
 
@@ -321,28 +387,30 @@ class GtkBaseGUI(BaseGUI):
                 'vbox': vbox,
                 'message': lbl,
                 'progress': pbar}
-            wait_lock.release()
-        with wait_lock:
-            if _now:
-                show(self)
-            else:
-                gobject.idle_add(show, self)
-            wait_lock.acquire()
+        self._call_and_wait(show, _now=_now)
 
     def hide_splash_screen(self, _now=False):
-        wait_lock = threading.Lock()
         def hide(self):
             for k in self.splash or []:
                 if hasattr(self.splash[k], 'destroy'):
                     self.splash[k].destroy()
             self.splash = None
-            wait_lock.release()
-        with wait_lock:
-            if _now:
-                hide(self)
-            else:
-                gobject.idle_add(hide, self)
-            wait_lock.acquire()
+        self._call_and_wait(hide, _now=_now)
+
+    def _call_and_wait(self, func, _now=False):
+        # Run func(self) on the GTK thread and block until it is done;
+        # calls made on the GTK thread itself run directly.
+        if _now or threading.current_thread() is self._gtk_thread:
+            func(self)
+            return
+        done = threading.Event()
+        def call(self):
+            try:
+                func(self)
+            finally:
+                done.set()
+        self._enqueue(call, self)
+        done.wait()
 
     def notify_user(self,
             message='Hello', popup=False, alert=False, actions=None):
@@ -360,12 +428,19 @@ class GtkBaseGUI(BaseGUI):
                     popup_icon = self._theme_image(self.config['app_icon'])
                 popup_appname = self.config.get('app_name', 'gui-o-matic')
                 if pynotify is not None:
+                    popup_key = (popup_appname, message, popup_icon)
                     if self.popup is None:
                         self.popup = pynotify.Notification(
                             popup_appname, message, popup_icon)
                         self.popup.set_urgency(pynotify.URGENCY_NORMAL)
+                        # Once dismissed, the same message may pop up again
+                        self.popup.connect('closed', self._popup_closed)
+                    elif popup_key == self._last_popup:
+                        # Already showing this, skip the DBus round-trip
+                        return
                     self.popup.update(popup_appname, message, popup_icon)
                     self.popup.show()
+                    self._last_popup = popup_key
                     return
                 elif not self.config.get('disable-popup-fallback'):
                     try:
@@ -382,20 +457,21 @@ class GtkBaseGUI(BaseGUI):
             if self.splash:
                 self.update_splash_screen(message=message, _now=True)
             elif self.main_window:
-                msg = message.replace('<', '&lt;')
+                msg = message.translate(_ESCAPE)
                 self.main_window['notification'].set_markup(msg)
             else:
                 print(('FIXME: Notify: %s' % message))
-        gobject.idle_add(notify, self)
+        self._enqueue(notify, self)
+
+    def _popup_closed(self, notification):
+        self._last_popup = None
 
     def _indicator_setup(self):
         pass
 
     def _indicator_set_icon(self, icon, **kwargs):
         if 'indicator_icon' in self.main_window:
-            themed_icon = self._theme_image(icon)
-            img = gtk.gdk.pixbuf_new_from_file(themed_icon)
-            img = img.scale_simple(32, 32, gtk.gdk.INTERP_BILINEAR)
+            img = self._scaled_pixbuf(icon, 32)
             self.main_window['indicator_icon'].set_from_pixbuf(img)
 
     def _indicator_set_status(self, status, **kwargs):
@@ -409,7 +485,7 @@ class GtkBaseGUI(BaseGUI):
         if _now:
             do = lambda o, a: o(a)
         else:
-            do = gobject.idle_add
+            do = self._enqueue
         images = self.config.get('images')
         if images:
             icon = images.get(status)
@@ -421,6 +497,25 @@ class GtkBaseGUI(BaseGUI):
 
     def set_status_display(self,
             id=None, title=None, details=None, icon=None, color=None):
+        update = {'title': title, 'details': details,
+                  'icon': icon, 'color': color}
+        with self._pending_lock:
+            # Merge into a not-yet-applied update, so only the latest
+            # value of each field gets drawn.
+            pending = self._pending_displays.get(id)
+            if pending is not None:
+                pending.update((k, v) for k, v in update.items() if v)
+                return
+            self._pending_displays[id] = update
+        self._enqueue(self._apply_status_display, id)
+
+    def _apply_status_display(self, id):
+        with self._pending_lock:
+            update = self._pending_displays.pop(id)
+        self._set_status_display_now(id, **update)
+
+    def _set_status_display_now(self,
+            id=None, title=None, details=None, icon=None, color=None):
         status = self.status_display.get(id)
         if not status:
             return
@@ -432,24 +527,22 @@ class GtkBaseGUI(BaseGUI):
         if details:
             status['details'].set_markup(details)
         if color:
-            color = gtk.gdk.color_parse(color)
-            for which in ('title', 'details'):
-                status[which].modify_fg(gtk.STATE_NORMAL, color)
-                status[which].modify_text(gtk.STATE_NORMAL, color)
+            parsed = _COLOR_CACHE.get(color)
+            if parsed is None:
+                parsed = _COLOR_CACHE[color] = gtk.gdk.color_parse(color)
+            # One style change per label, instead of separate fg and text.
+            # Start from the label's own modifier style to keep its font.
+            for label in (status['title'], status['details']):
+                rc_style = label.get_modifier_style()
+                rc_style.fg[gtk.STATE_NORMAL] = parsed
+                rc_style.text[gtk.STATE_NORMAL] = parsed
+                label.modify_style(rc_style)
 
     def set_item(self, id=None, label=None, sensitive=None):
-        if label is not None and id and id in self.items:
-            def set_label(label):
-                obj = self.items[id]
-                if (isinstance(obj, gtk.Button)
-                        and 'buttons' in self.font_styles):
-                    obj.set_label(' %s ' % label)
-                    obj.get_child().modify_font(self.font_styles['buttons'])
-                else:
-                    obj.set_label(label)
-            gobject.idle_add(set_label, label)
+        if label is not None and id and id in self._set_label_fns:
+            self._enqueue(self._set_label_fns[id], label)
         if sensitive is not None and id and id in self.items:
-            gobject.idle_add(self.items[id].set_sensitive, sensitive)
+            self._enqueue(self.items[id].set_sensitive, sensitive)
 
     def _font_setup(self):
         for name, style in self.config.get('font_styles', {}).items():
@@ -460,6 +553,18 @@ class GtkBaseGUI(BaseGUI):
             if style.get('bold'): pfd.set_weight(pango.WEIGHT_BOLD)
             self.font_styles[name] = pfd
 
+        # Resolve each status display's fonts once: an exact "<id>_title"
+        # style wins over the generic "title" one.
+        self._resolved_fonts = {}
+        sd_defs = (self.config.get('main_window', {}).get('status_displays')
+                   or [{'id': 'notification'}])
+        for st in sd_defs:
+            for which in ('title', 'details'):
+                pfd = self.font_styles.get('%s_%s' % (st['id'], which),
+                                           self.font_styles.get(which))
+                if pfd is not None:
+                    self._resolved_fonts[(st['id'], which)] = pfd
+
     def run(self):
         self._font_setup()
         self._menu_setup()
@@ -470,8 +575,9 @@ class GtkBaseGUI(BaseGUI):
 
         def ready(s):
             s.ready = True
-        gobject.idle_add(ready, self)
+        self._enqueue(ready, self)
 
+        self._gtk_thread = threading.current_thread()
         try:
             gtk.main()
         except:
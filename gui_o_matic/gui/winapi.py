@@ -13,10 +13,10 @@ import win32ui
 import win32print
 import commctrl
 import ctypes
+import ctypes.wintypes
 
 # Utility imports
 import re
-import tempfile
 import PIL.Image
 import os
 import uuid
@@ -25,7 +25,9 @@ import atexit
 import itertools
 import struct
 import functools
-import queue
+import threading
+import collections
+import weakref
 
 from . import pil_bmp_fix
 
@@ -34,44 +36,214 @@ from . import pil_bmp_fix
 BMP_FORMAT = "BMP+ALPHA"
 PIL.Image.register_save( BMP_FORMAT, pil_bmp_fix._save )
 
+# ANTIALIAS is gone in Pillow 10; Resampling only exists since Pillow 9.1
+try:
+    _RESAMPLE = PIL.Image.Resampling.LANCZOS
+except AttributeError:
+    _RESAMPLE = PIL.Image.LANCZOS
+
 from gui_o_matic.gui.base import BaseGUI
 
-def rect_intersect( rect_a, rect_b ):
-    x_min = max(rect_a[0], rect_b[0])
-    y_min = max(rect_a[1], rect_b[1])
-    x_max = min(rect_a[2], rect_b[2])
-    y_max = min(rect_a[3], rect_b[3])
-    return (x_min, y_min, x_max, y_max)
+# System icon sizes don't change while we run
+_ICON_LARGE_SIZE = (win32api.GetSystemMetrics( win32con.SM_CXICON ),
+                    win32api.GetSystemMetrics( win32con.SM_CYICON ))
+_ICON_SMALL_SIZE = (win32api.GetSystemMetrics( win32con.SM_CXSMICON ),
+                    win32api.GetSystemMetrics( win32con.SM_CYSMICON ))
+
+class _BITMAPINFOHEADER( ctypes.Structure ):
+    _fields_ = [ ('biSize', ctypes.wintypes.DWORD),
+                 ('biWidth', ctypes.wintypes.LONG),
+                 ('biHeight', ctypes.wintypes.LONG),
+                 ('biPlanes', ctypes.wintypes.WORD),
+                 ('biBitCount', ctypes.wintypes.WORD),
+                 ('biCompression', ctypes.wintypes.DWORD),
+                 ('biSizeImage', ctypes.wintypes.DWORD),
+                 ('biXPelsPerMeter', ctypes.wintypes.LONG),
+                 ('biYPelsPerMeter', ctypes.wintypes.LONG),
+                 ('biClrUsed', ctypes.wintypes.DWORD),
+                 ('biClrImportant', ctypes.wintypes.DWORD) ]
+
+class _ICONINFO( ctypes.Structure ):
+    _fields_ = [ ('fIcon', ctypes.wintypes.BOOL),
+                 ('xHotspot', ctypes.wintypes.DWORD),
+                 ('yHotspot', ctypes.wintypes.DWORD),
+                 ('hbmMask', ctypes.wintypes.HBITMAP),
+                 ('hbmColor', ctypes.wintypes.HBITMAP) ]
+
+_CreateDIBSection = ctypes.windll.gdi32.CreateDIBSection
+_CreateDIBSection.restype = ctypes.wintypes.HBITMAP
+_CreateDIBSection.argtypes = ( ctypes.wintypes.HDC,
+                               ctypes.POINTER( _BITMAPINFOHEADER ),
+                               ctypes.wintypes.UINT,
+                               ctypes.POINTER( ctypes.c_void_p ),
+                               ctypes.wintypes.HANDLE,
+                               ctypes.wintypes.DWORD )
+
+_CreateIconIndirect = ctypes.windll.user32.CreateIconIndirect
+_CreateIconIndirect.restype = ctypes.wintypes.HICON
+_CreateIconIndirect.argtypes = ( ctypes.POINTER( _ICONINFO ), )
+
+# Hex color components, one and two digit forms scaled to 0-255
+_HEX8 = { '{:02x}'.format( value ): value for value in range( 256 ) }
+_HEX4 = { '{:x}'.format( value ): value * 17 for value in range( 16 ) }
+
+# Placeholder for missing images
+_EMPTY_IMAGE = PIL.Image.new( "RGBA", (1,1), color = (0,0,0,0) )
+
+# Buffered painting (uxtheme, Vista and later) renders all layers into an
+# offscreen bitmap and copies it to the window in one go.
+try:
+    _uxtheme = ctypes.windll.uxtheme
+    _uxtheme.BufferedPaintInit()
+    _BeginBufferedPaint = _uxtheme.BeginBufferedPaint
+    _BeginBufferedPaint.restype = ctypes.wintypes.HANDLE
+    _BeginBufferedPaint.argtypes = ( ctypes.wintypes.HDC,
+                                     ctypes.POINTER( ctypes.wintypes.RECT ),
+                                     ctypes.wintypes.DWORD,
+                                     ctypes.c_void_p,
+                                     ctypes.POINTER( ctypes.wintypes.HDC ) )
+    _EndBufferedPaint = _uxtheme.EndBufferedPaint
+    _EndBufferedPaint.argtypes = ( ctypes.wintypes.HANDLE, ctypes.wintypes.BOOL )
+except (OSError, AttributeError):
+    _BeginBufferedPaint = None
+
+_BPBF_COMPATIBLEBITMAP = 0
+
+_FillRect = ctypes.windll.user32.FillRect
+_FillRect.argtypes = ( ctypes.wintypes.HDC,
+                       ctypes.POINTER( ctypes.wintypes.RECT ),
+                       ctypes.wintypes.HBRUSH )
+
+_GetSysColorBrush = ctypes.windll.user32.GetSysColorBrush
+_GetSysColorBrush.restype = ctypes.wintypes.HBRUSH
+
+# Constant for the life of the process, shared by all windows and controls
+_MODULE_HANDLE = win32gui.GetModuleHandle( None )
+_ARROW_CURSOR = win32gui.LoadCursor( None, win32con.IDC_ARROW )
+
+def _create_dib( source ):
+    '''
+    Create a 32bpp top-down DIB section holding an RGBA PIL image.
+    '''
+    header = _BITMAPINFOHEADER()
+    header.biSize = ctypes.sizeof( _BITMAPINFOHEADER )
+    header.biWidth = source.width
+    header.biHeight = -source.height # negative height: top-down rows
+    header.biPlanes = 1
+    header.biBitCount = 32
+    header.biCompression = win32con.BI_RGB
+
+    bits = ctypes.c_void_p()
+    handle = _CreateDIBSection( None, ctypes.byref( header ),
+                                win32con.DIB_RGB_COLORS,
+                                ctypes.byref( bits ), None, 0 )
+    if not handle:
+        raise ctypes.WinError()
+    data = source.tobytes( 'raw', 'BGRA' )
+    ctypes.memmove( bits, data, len( data ) )
+    return handle
+
+def _create_icon( source ):
+    '''
+    Create an icon from an RGBA PIL image: the DIB carries the colors and
+    alpha, the monochrome mask is the alpha channel thresholded.
+    '''
+    color = _create_dib( source )
+
+    # Monochrome bitmap rows are WORD aligned, so pad the width to 16 bits
+    mask = source.getchannel( 'A' ).point( lambda a: 255 if a < 128 else 0 )
+    padded = PIL.Image.new( '1', ((source.width + 15) // 16 * 16, source.height), 0 )
+    padded.paste( mask.convert( '1' ), (0, 0) )
+    mask = win32gui.CreateBitmap( source.width, source.height, 1, 1, padded.tobytes() )
+
+    try:
+        info = _ICONINFO( True, 0, 0, int( mask ), color )
+        handle = _CreateIconIndirect( ctypes.byref( info ) )
+        if not handle:
+            raise ctypes.WinError()
+        return handle
+    finally:
+        # The icon keeps its own copies
+        win32gui.DeleteObject( mask )
+        win32gui.DeleteObject( color )
+
+def _text_extent( hdc, text, single_line ):
+    '''
+    Measure text with whatever font is selected into hdc.
+    '''
+    # Height from DT_CALCRECT is strange...maybe troubleshoot later...
+    #height, roi = win32gui.DrawText( hdc,
+    #                                  text,
+    #                                  len( text ),
+    #                                  rect,
+    #                                  style | win32con.DT_CALCRECT )
+
+    # FIXME: manually line wrap:(
+    #
+    if single_line:
+        return win32gui.GetTextExtentPoint32( hdc, text )
+
+    (total_width, total_height) = (0,0)
+    for line in text.split( '\r\n' ):
+        (width,height) = win32gui.GetTextExtentPoint32( hdc, line )
+        total_height += height
+        total_width = max( total_width, width )
+    return (total_width, total_height)
+
+@functools.lru_cache( maxsize = 1000 )
+def _measure_text( font, text, single_line ):
+    '''
+    Measure text in a given font. Extents only depend on font and text, so
+    this is shared by all text layers.
+    '''
+    hdc = win32gui.GetDC( 0 )
+    original_font = win32gui.SelectObject( hdc, font )
+    try:
+        return _text_extent( hdc, text, single_line )
+    finally:
+        win32gui.SelectObject( hdc, original_font )
+        win32gui.ReleaseDC( 0, hdc )
 
 class Image( object ):
     '''
     Helper class for importing arbitrary graphics to winapi bitmaps. Mode is a
-    tuple of (winapi image type, file extension, and cleanup callback).
+    tuple of (handle factory, file extension, and cleanup callback).
     '''
 
+    __slots__ = ('size', 'mode', 'handle', '__weakref__')
+
     @classmethod
     def Bitmap( cls, *args, **kwargs ):
-        mode = (win32con.IMAGE_BITMAP,'bmp',win32gui.DeleteObject)
+        mode = (_create_dib,'bmp',win32gui.DeleteObject)
         return cls( *args, mode = mode, **kwargs )
 
     # https://blog.barthe.ph/2009/07/17/wmseticon/
     #
     @classmethod
     def Icon( cls, *args, **kwargs ):
-        mode = (win32con.IMAGE_ICON,'ico',win32gui.DestroyIcon)
+        mode = (_create_icon,'ico',win32gui.DestroyIcon)
         return cls( *args, mode = mode, **kwargs )
 
     @classmethod
     def IconLarge( cls, *args, **kwargs ):
-        dims =(win32con.SM_CXICON, win32con.SM_CYICON)
-        size = tuple(map(win32api.GetSystemMetrics,dims))
-        return cls.Icon( *args, size = size, **kwargs )
+        return cls.Icon( *args, size = _ICON_LARGE_SIZE, **kwargs )
 
     @classmethod
     def IconSmall( cls, *args, **kwargs ):
-        dims =(win32con.SM_CXSMICON, win32con.SM_CYSMICON)
-        size = tuple(map(win32api.GetSystemMetrics,dims))
-        return cls.Icon( *args, size = size, **kwargs )
+        return cls.Icon( *args, size = _ICON_SMALL_SIZE, **kwargs )
+
+    @classmethod
+    def from_rgba_pil( cls, source ):
+        '''
+        Wrap an in-memory RGBA PIL image as a bitmap, skipping the mode and
+        size handling in __init__.
+        '''
+        assert( source.mode == 'RGBA' )
+        image = cls.__new__( cls )
+        image.size = source.size
+        image.mode = (_create_dib,'bmp',win32gui.DeleteObject)
+        image.handle = _create_dib( source )
+        return image
 
     def __init__( self, path, mode, size = None, debug = None ):
         '''
@@ -93,8 +265,8 @@ class Image( object ):
             if not hasattr( size, '__len__' ):
                 factor = float( size ) / max( source.size )
                 size = tuple([ int(factor * dim) for dim in source.size ])
-            source = source.resize( size, PIL.Image.ANTIALIAS )
-            #source.thumbnail( size, PIL.Image.ANTIALIAS )
+            source = source.resize( size, _RESAMPLE )
+            #source.thumbnail( size, _RESAMPLE )
 
         self.size = source.size
         self.mode = mode
@@ -102,19 +274,8 @@ class Image( object ):
         if debug:
             source.save( debug, mode[ 1 ] )
 
-        with tempfile.NamedTemporaryFile( delete = False ) as handle:
-            filename = handle.name
-            source.save( handle, mode[ 1 ] )
-
-        try:
-            self.handle = win32gui.LoadImage( None,
-                                              handle.name,
-                                              mode[ 0 ],
-                                              source.width,
-                                              source.height,
-                                              win32con.LR_LOADFROMFILE )#| win32con.LR_CREATEDIBSECTION )
-        finally:
-            os.unlink( filename )
+        # Copy pixels straight into a DIB, no temporary file round-trip
+        self.handle = mode[ 0 ]( source )
 
     def __del__( self ):
         # TODO: swap mode to a more descriptive structure
@@ -130,16 +291,23 @@ class Compositor( object ):
     in python, then move them out to winapi as RGB
     '''
 
+    # Mixin: subclasses provide the 'operations' slot
+    __slots__ = ()
+
     class Operation( object ):
         '''
         Applies and effect to an image
         '''
 
+        __slots__ = ()
+
     class Fill( Operation ):
         '''
         Stretches the target region with the specified color.
         '''
 
+        __slots__ = ('rect', 'color')
+
         def __init__( self, color, rect = None ):
             self.rect = rect
             self.color = color
@@ -150,6 +318,8 @@ class Compositor( object ):
 
     class Blend( Operation ):
 
+        __slots__ = ('source', 'rect')
+
         def __init__( self, source, rect = None ):
             self.set_image( source )
             self.rect = rect
@@ -161,16 +331,22 @@ class Compositor( object ):
             rect = self.rect or (0, 0, image.width, image.height)
             dst_size = (rect[2] - rect[0], rect[3] - rect[1])
             if dst_size != self.source.size:
-                scaled = self.source.resize( dst_size, PIL.Image.ANTIALIAS )
+                scaled = self.source.resize( dst_size, _RESAMPLE )
             else:
                 scaled = self.source
-            dst = image.crop( rect )
-            blend = dst.alpha_composite( scaled )
-            image.paste( dst, rect )
+            image.alpha_composite( scaled, dest = (rect[0], rect[1]) )
 
     def render( self, size, background = (0,0,0,0) ):
+        operations = self.operations
+        # A leading full-image fill is just a background color, which
+        # PIL.Image.new applies while allocating instead of another pass.
+        if operations and isinstance( operations[0], Compositor.Fill ) \
+                and operations[0].rect is None:
+            background = operations[0].color
+            operations = operations[1:]
+
         image = PIL.Image.new( "RGBA", size, background )
-        for operation in self.operations:
+        for operation in operations:
             operation( image )
         return image
 
@@ -181,18 +357,19 @@ class Registry( object ):
     '''
     Registry that maps objects to IDs
     '''
-    _objectmap = {}
+    # IDs are handed out densely from _id_base, so a list indexed by
+    # (id - _id_base) is all the map we need.
+    _objectmap = []
 
-    _next_id = 1024
+    _id_base = 1024
 
     @classmethod
     def register( cls, obj, dst_attr = 'registry_id' ):
         '''
         Register an object at the next available id.
         '''
-        next_id = cls._next_id
-        cls._next_id = next_id + 1
-        cls._objectmap[ next_id ] = obj
+        next_id = cls._id_base + len( cls._objectmap )
+        cls._objectmap.append( obj )
         if dst_attr:
             setattr( obj, dst_attr, next_id )
 
@@ -201,9 +378,15 @@ class Registry( object ):
         '''
         Get a registered action by id, probably for invoking it.
         '''
-        return cls._objectmap[ registry_id ]
+        index = registry_id - cls._id_base
+        if not 0 <= index < len( cls._objectmap ):
+            raise KeyError( registry_id )
+        return cls._objectmap[ index ]
 
     class AutoRegister( object ):
+
+        __slots__ = ('registry_id',)
+
         def __init__( self, *args ):
             '''
             Register subclasses at init time.
@@ -219,6 +402,8 @@ class Action( Registry.AutoRegister ):
     WM_COMMAND etc to be easily mapped to gui-o-matic protocol elements.
     '''
 
+    __slots__ = ('gui', 'identifier', 'label', 'operation', 'sensitive', 'args')
+
 
     def __init__( self, gui, identifier, label, operation = None, sensitive = True, args = None ):
         '''
@@ -281,76 +466,122 @@ class Window( object ):
         Implement __call__ to update the window as desired.
         '''
 
+        __slots__ = ('_hdc_mem', '_prior_bitmap', '_selected_bitmap')
+
+        def __init__( self ):
+            self._hdc_mem = None
+            self._prior_bitmap = None
+            self._selected_bitmap = None
+
         def __call__( self, window, hdc, paint_struct ):
             raise NotImplementedError
 
+        def _memory_dc( self, bitmap_handle ):
+            '''
+            Get a memory DC with bitmap_handle selected, reusing the one
+            from the last paint where possible.
+            '''
+            if self._hdc_mem is None:
+                screen = win32gui.GetDC( 0 )
+                self._hdc_mem = win32gui.CreateCompatibleDC( screen )
+                win32gui.ReleaseDC( 0, screen )
+                self._prior_bitmap = None
+                self._selected_bitmap = None
+            if self._selected_bitmap != bitmap_handle:
+                prior = win32gui.SelectObject( self._hdc_mem, bitmap_handle )
+                if self._prior_bitmap is None:
+                    self._prior_bitmap = prior
+                self._selected_bitmap = bitmap_handle
+            return self._hdc_mem
+
+        def _release_memory_dc( self ):
+            '''
+            Deselect our bitmap (so it can be deleted) and drop the memory DC.
+            '''
+            if self._hdc_mem is not None:
+                win32gui.SelectObject( self._hdc_mem, self._prior_bitmap )
+                win32gui.DeleteDC( self._hdc_mem )
+                self._hdc_mem = None
+
+        def __del__( self ):
+            self._release_memory_dc()
+
     class CompositorLayer( Layer, Compositor ):
         '''
         Layer that moves compositor output into an HDC, caching rendering.
         '''
 
+        __slots__ = ('operations', 'image', 'rect', 'background', '_cache')
+
+        # Number of rendered bitmaps to keep, by (size, background)
+        _CACHE_SIZE = 8
+
         def __init__( self, rect = None, background = None ):
             super(Window.CompositorLayer, self).__init__()
             self.image = None
             self.rect = rect
             self.background = background
+            self._cache = collections.OrderedDict()
 
-        def update( self, window, hdc ):
-            rect = self.rect or window.get_client_region()
-            try:
-                background = self.background or win32gui.GetPixel( hdc, rect[0], rect[1] )
-                self.last_background = background
-            except:
-                print("FIXME: Figure out why GetPixel( hdc, 0, 0 ) is failing...")
-                #traceback.print_exc()
-                #print "GetLastError() => {}".format( win32api.GetLastError() )
-                background = self.last_background
+        def update( self, window, hdc, rect = None ):
+            rect = rect or self.rect or window.get_client_region()
+            background = self.background or window.background_color
 
             color = ((background >> 0 ) & 255,
                      (background >> 8 ) & 255,
                      (background >> 16 ) & 255,
                      255)
             size = ( rect[2] - rect[0], rect[3] - rect[1] )
-            combined = self.render( size, color )
-            self.image = Image.Bitmap( combined )
 
-        def dirty( self, window ):
-            rect = self.rect or window.get_client_region()
+            key = (size, color)
+            image = self._cache.pop( key, None )
+            if image is None:
+                combined = self.render( size, color )
+                image = Image.from_rgba_pil( combined )
+                # Nothing else holds on to compositor bitmaps
+                weakref.finalize( image, win32gui.DeleteObject, image.handle )
+                if len( self._cache ) >= self._CACHE_SIZE:
+                    self._cache.popitem( last = False )
+            self._cache[ key ] = image
+            self.image = image
+
+        def dirty( self, window, rect = None ):
+            rect = rect or self.rect or window.get_client_region()
             size = ( rect[2] - rect[0], rect[3] - rect[1] )
             result = self.image is None or self.image.size != size
             return result
 
         def invalidate( self ):
+            self._release_memory_dc()
             self.image = None
+            self._cache.clear()
 
         def __call__( self, window, hdc, paint_struct ):
-            dirty = self.dirty( window )
-            if dirty:
-                self.update( window, hdc )
-
             rect = self.rect or window.get_client_region()
-            roi = rect_intersect( rect, paint_struct[2] )
-            hdc_mem = win32gui.CreateCompatibleDC( hdc )
-            prior_bitmap = win32gui.SelectObject( hdc_mem, self.image.handle )
+            if self.dirty( window, rect ):
+                self.update( window, hdc, rect )
+
+            hdc_mem = self._memory_dc( self.image.handle )
 
+            # BeginPaint already clipped hdc to the update region, so GDI
+            # only copies what actually needs repainting.
             win32gui.BitBlt( hdc,
-                             roi[0],
-                             roi[1],
-                             roi[2] - roi[0],
-                             roi[3] - roi[1],
+                             rect[0],
+                             rect[1],
+                             rect[2] - rect[0],
+                             rect[3] - rect[1],
                              hdc_mem,
-                             roi[0] - rect[0],
-                             roi[1] - rect[1],
+                             0,
+                             0,
                              win32con.SRCCOPY )
 
-            win32gui.SelectObject( hdc_mem, prior_bitmap )
-            win32gui.DeleteDC( hdc_mem )
-
     class BitmapLayer( Layer ):
         '''
         Stretch a bitmap across an ROI. May no longer be useful...
         '''
 
+        __slots__ = ('bitmap', 'src_roi', 'dst_roi', 'blend')
+
         def __init__( self, bitmap, src_roi = None, dst_roi = None, blend = None ):
             super(Window.BitmapLayer, self).__init__()
             self.bitmap = bitmap
@@ -361,11 +592,10 @@ class Window( object ):
 
         def __call__( self, window, hdc, paint_struct ):
             src_roi = self.src_roi or (0, 0, self.bitmap.size[0], self.bitmap.size[1])
-            dst_roi = self.dst_roi or win32gui.GetClientRect( window.window_handle )
+            dst_roi = self.dst_roi or window.get_client_region()
             blend = self.blend or (win32con.AC_SRC_OVER, 0, 255, win32con.AC_SRC_ALPHA )
 
-            hdc_mem = win32gui.CreateCompatibleDC( hdc )
-            prior = win32gui.SelectObject( hdc_mem, self.bitmap.handle )
+            hdc_mem = self._memory_dc( self.bitmap.handle )
 
             # Blit with alpha channel blending
             win32gui.AlphaBlend( hdc,
@@ -380,19 +610,20 @@ class Window( object ):
                                  src_roi[ 3 ] - src_roi[ 1 ],
                                  blend )
 
-            win32gui.SelectObject( hdc_mem, prior )
-            win32gui.DeleteDC( hdc_mem )
-
 
     class TextLayer( Layer ):
         '''
         Stub text layer, need to add font handling.
         '''
 
+        __slots__ = ('text', 'rect', 'style', 'font', 'color', 'bk_mode',
+                     'height', 'width', 'roi')
+
         def __init__( self, text, rect, style = win32con.DT_WORDBREAK,
                       font = None,
                       color = None ):
             assert( isinstance( style, int ) )
+            super(Window.TextLayer, self).__init__()
             self.text = text
             self.rect = rect
             self.style = style
@@ -403,13 +634,12 @@ class Window( object ):
             self.roi = None
 
         def _set_text( self, text ):
-            self.text = re.sub( "(\r\n|\n|\r)", "\r\n", text, re.M )
+            # Normalize all line endings to what DrawText expects
+            self.text = text.replace( "\r\n", "\n" ).replace( "\r", "\n" ).replace( "\n", "\r\n" )
 
         def set_props( self, window = None, **kwargs ):
 
-            if window and self.roi:
-                win32gui.InvalidateRect( window.window_handle,
-                                         self.roi, True )
+            prior_roi = self.roi
 
             for key in ('text','rect','style','font','color'):
                 if key in kwargs:
@@ -423,8 +653,16 @@ class Window( object ):
                 hdc = win32gui.GetWindowDC( window.window_handle )
                 roi = self.calc_roi( hdc )
                 win32gui.ReleaseDC( window.window_handle, hdc )
+
+                # Repaint where the text was and where it is now in one go.
+                # No erase: the window erases during WM_PAINT.
+                if prior_roi:
+                    roi = (min( roi[0], prior_roi[0] ),
+                           min( roi[1], prior_roi[1] ),
+                           max( roi[2], prior_roi[2] ),
+                           max( roi[3], prior_roi[3] ))
                 win32gui.InvalidateRect( window.window_handle,
-                                         roi, True )
+                                         roi, False )
 
         def calc_roi( self, hdc ):
             '''
@@ -437,31 +675,12 @@ class Window( object ):
             to back out actual roi.
             '''
 
+            # Without a font of our own the size depends on the hdc
+            single_line = bool( self.style & win32con.DT_SINGLELINE )
             if self.font:
-                original_font = win32gui.SelectObject( hdc, self.font )
-
-            # Height from DT_CALCRECT is strange...maybe troubleshoot later...
-            #height, roi = win32gui.DrawText( hdc,
-            #                                  self.text,
-            #                                  len( self.text ),
-            #                                  self.rect,
-            #                                  self.style | win32con.DT_CALCRECT )
-            #self.width = roi[2] - roi[0]
-            #print "roi {}".format( (self.width, self.height) )
-
-            # FIXME: manually line wrap:(
-            #
-            if self.style & win32con.DT_SINGLELINE:
-                (self.width,self.height) = win32gui.GetTextExtentPoint32( hdc, self.text )
+                (self.width, self.height) = _measure_text( self.font, self.text, single_line )
             else:
-                (self.width, self.height) = (0,0)
-                for line in self.text.split( '\r\n' ):
-                    (width,height) = win32gui.GetTextExtentPoint32( hdc, line )
-                    self.height += height
-                    self.width = max( self.width, width )
-
-            if self.font:
-                win32gui.SelectObject( hdc, original_font )
+                (self.width, self.height) = _text_extent( hdc, self.text, single_line )
 
             # Resolve text style against DC alignment
             #
@@ -488,7 +707,7 @@ class Window( object ):
             # Calc ROI from resolved alignment
             #
             if horizontal == win32con.TA_CENTER:
-                x_min = (self.rect[ 2 ] + self.rect[ 0 ] - self.width)/2
+                x_min = (self.rect[ 2 ] + self.rect[ 0 ] - self.width)//2
                 x_max = x_min + self.width
             elif horizontal == win32con.TA_RIGHT:
                 x_min = self.rect[ 2 ] - self.width
@@ -498,7 +717,7 @@ class Window( object ):
                 x_max = self.rect[ 0 ] + self.width
 
             if vertical == win32con.VTA_CENTER:
-                y_min = (self.rect[ 1 ] + self.rect[ 3 ] - self.height)/2
+                y_min = (self.rect[ 1 ] + self.rect[ 3 ] - self.height)//2
                 y_max = y_min + self.height
             elif vertical == win32con.TA_BOTTOM:
                 y_min = self.rect[ 3 ] - self.height
@@ -510,19 +729,26 @@ class Window( object ):
             self.roi = (x_min, y_min, x_max, y_max)
             return self.roi
 
-        __mode_setters = {
-            'font': win32gui.SelectObject,
-            'color': win32gui.SetTextColor,
-            'bk_mode': win32gui.SetBkMode
-        }
+        __mode_setters = (
+            ('color', win32gui.SetTextColor),
+            ('bk_mode', win32gui.SetBkMode)
+        )
 
         def __call__( self, window, hdc, paint_struct ):
 
-            prior = {}
-            for key, setter in list(self.__mode_setters.items()):
+            # Fonts stay selected between layers, the window restores the
+            # original one at the end of the paint.
+            if self.font is not None and window._current_font != self.font:
+                original_font = win32gui.SelectObject( hdc, self.font )
+                if window._original_font is None:
+                    window._original_font = original_font
+                window._current_font = self.font
+
+            prior = []
+            for key, setter in self.__mode_setters:
                 value = getattr( self, key )
                 if value is not None:
-                    prior[ key ] = setter( hdc, getattr( self, key ) )
+                    prior.append( (setter, setter( hdc, value )) )
 
             self.calc_roi( hdc )
 
@@ -532,8 +758,8 @@ class Window( object ):
                                self.rect,
                                self.style )
 
-            for key, value in list(prior.items()):
-                self.__mode_setters[ key ]( hdc, value )
+            for setter, value in prior:
+                setter( hdc, value )
 
 
     class Control( Registry.AutoRegister ):
@@ -541,6 +767,8 @@ class Window( object ):
         Base class for controls based subwindows (common controls)
         '''
 
+        __slots__ = ('action', 'handle')
+
         _next_control_id = 1024
 
         def __init__( self ):
@@ -573,6 +801,8 @@ class Window( object ):
 
     class Button( Control ):
 
+        __slots__ = ()
+
         def __init__( self, parent, rect, action ):
             super( Window.Button, self ).__init__()
 
@@ -588,7 +818,7 @@ class Window( object ):
                                                    rect[ 3 ],
                                                    parent.window_handle,
                                                    self.registry_id,
-                                                   win32gui.GetModuleHandle(None),
+                                                   _MODULE_HANDLE,
                                                    None )
             self.set_action( action )
 
@@ -597,6 +827,9 @@ class Window( object ):
 
 
     class ProgressBar( Control ):
+
+        __slots__ = ()
+
         # https://msdn.microsoft.com/en-us/library/windows/desktop/hh298373(v=vs.85).aspx
         #
         def __init__( self, parent ):
@@ -613,7 +846,7 @@ class Window( object ):
                                                    yscroll,
                                                    parent.window_handle,
                                                    self.registry_id,
-                                                   win32gui.GetModuleHandle(None),
+                                                   _MODULE_HANDLE,
                                                    None )
 
 
@@ -642,8 +875,9 @@ class Window( object ):
                  messages = {}):
         '''Setup a window class and a create window'''
         self.layers = []
-        self.module_handle = win32gui.GetModuleHandle(None)
+        self.module_handle = _MODULE_HANDLE
         self.systray = False
+        self._menu_handle = None
         self.systray_map = {
             win32con.WM_RBUTTONDOWN: self._show_menu
             }
@@ -653,19 +887,29 @@ class Window( object ):
         self.window_class_name = self._make_window_class_name()
         self.message_map = {
              win32con.WM_PAINT: self._on_paint,
+             win32con.WM_ERASEBKGND: self._on_erase_background,
              win32con.WM_CLOSE: self._on_close,
              win32con.WM_COMMAND: self._on_command,
+             win32con.WM_SIZE: self._on_size,
              self._notify_event_id: self._on_notify,
              }
         self.message_map.update( messages )
         self.window_class = win32gui.WNDCLASS()
         self.window_class.style = win32con.CS_HREDRAW | win32con.CS_VREDRAW
+        # Keep this a dict: pywin32 looks messages up in C and passes unmapped
+        # ones straight to DefWindowProc, so only handled messages ever reach
+        # python. A callable windproc would be entered for every message.
         self.window_class.lpfnWndProc = self.message_map
         self.window_class.hInstance = self.module_handle
-        self.window_class.hCursor = win32gui.LoadCursor( None, win32con.IDC_ARROW )
+        self.window_class.hCursor = _ARROW_CURSOR
         self.window_class.hbrBackground = win32con.COLOR_WINDOW
         self.window_class.lpszClassName = self.window_class_name
 
+        # A system color brush is (color index + 1), so this is the color
+        # the class brush actually erases the background with.
+        self.background_color = win32api.GetSysColor( self.window_class.hbrBackground - 1 )
+        self.background_brush = _GetSysColorBrush( self.window_class.hbrBackground - 1 )
+
         self.window_classHandle = win32gui.RegisterClass( self.window_class )
 
         self.window_handle = win32gui.CreateWindow(
@@ -680,6 +924,7 @@ class Window( object ):
             None,
             self.module_handle,
             None )
+        self._client_region = win32gui.GetClientRect( self.window_handle )
 
     def set_visibility( self, visibility  ):
         state = win32con.SW_SHOW if visibility else win32con.SW_HIDE
@@ -693,7 +938,8 @@ class Window( object ):
         return win32gui.GetWindowRect( self.window_handle )
 
     def get_client_region( self ):
-        return win32gui.GetClientRect( self.window_handle )
+        # Kept current by _on_size
+        return self._client_region
 
     def set_size( self, rect ):
         win32gui.MoveWindow( self.window_handle,
@@ -714,10 +960,10 @@ class Window( object ):
         screen_size = self.screen_size()
         width = rect[2]-rect[0]
         height = rect[3]-rect[1]
-        rect = ((screen_size[ 0 ] - width)/2,
-                (screen_size[ 1 ] - height)/2,
-                (screen_size[ 0 ] + width)/2,
-                (screen_size[ 1 ] + height)/2)
+        rect = ((screen_size[ 0 ] - width)//2,
+                (screen_size[ 1 ] - height)//2,
+                (screen_size[ 0 ] + width)//2,
+                (screen_size[ 1 ] + height)//2)
         self.set_size( rect )
 
     def focus( self ):
@@ -782,6 +1028,16 @@ class Window( object ):
 
     def set_menu( self, actions ):
         self.menu_actions = actions
+        self.invalidate_menu()
+
+    def invalidate_menu( self ):
+        '''
+        Discard the cached popup menu, so it gets rebuilt from
+        menu_actions the next time it is shown.
+        '''
+        if self._menu_handle is not None:
+            win32gui.DestroyMenu( self._menu_handle )
+            self._menu_handle = None
 
     def _on_command( self, window_handle, message, wparam, lparam ):
         target_id = win32gui.LOWORD(wparam)
@@ -797,15 +1053,17 @@ class Window( object ):
         return True
 
     def _show_menu( self ):
-        menu = win32gui.CreatePopupMenu()
-        for action in self.menu_actions:
-            if action:
-                flags = win32con.MF_STRING
-                if not action.sensitive:
-                    flags |= win32con.MF_GRAYED
-                win32gui.AppendMenu( menu, flags, action.get_id(), action.label )
-            else:
-                win32gui.AppendMenu( menu, win32con.MF_SEPARATOR, 0, '' )
+        if self._menu_handle is None:
+            self._menu_handle = win32gui.CreatePopupMenu()
+            for action in self.menu_actions:
+                if action:
+                    flags = win32con.MF_STRING
+                    if not action.sensitive:
+                        flags |= win32con.MF_GRAYED
+                    win32gui.AppendMenu( self._menu_handle, flags, action.get_id(), action.label )
+                else:
+                    win32gui.AppendMenu( self._menu_handle, win32con.MF_SEPARATOR, 0, '' )
+        menu = self._menu_handle
 
         pos = win32gui.GetCursorPos()
 
@@ -819,19 +1077,56 @@ class Window( object ):
                                  None )
         win32gui.PostMessage( self.window_handle, win32con.WM_NULL, 0, 0 )
 
+    def _on_erase_background( self, window_handle, message, wparam, lparam ):
+        # _on_paint erases what it repaints, doing it here too just flickers
+        return 1
+
     def _on_paint( self, window_handle, message, wparam, lparam ):
         (hdc, paint_struct) = win32gui.BeginPaint( self.window_handle )
+
+        # Render into an offscreen buffer if we can, to avoid flicker
+        target = hdc
+        paint_buffer = None
+        paint_rect = ctypes.wintypes.RECT( *paint_struct[2] )
+        if _BeginBufferedPaint is not None:
+            hdc_buffer = ctypes.wintypes.HDC()
+            paint_buffer = _BeginBufferedPaint( hdc,
+                                                ctypes.byref( paint_rect ),
+                                                _BPBF_COMPATIBLEBITMAP,
+                                                None,
+                                                ctypes.byref( hdc_buffer ) )
+            if paint_buffer:
+                target = hdc_buffer.value
+
+        # WM_ERASEBKGND is skipped, erase here instead: once, and into
+        # the buffer when there is one (its contents start out undefined).
+        _FillRect( target, ctypes.byref( paint_rect ), self.background_brush )
+
+        self._current_font = None
+        self._original_font = None
         for layer in self.layers:
-            layer( self, hdc, paint_struct )
+            layer( self, target, paint_struct )
+        if self._original_font is not None:
+            win32gui.SelectObject( target, self._original_font )
+
+        if paint_buffer:
+            _EndBufferedPaint( paint_buffer, True )
         win32gui.EndPaint( self.window_handle, paint_struct )
         return 0
 
+    def _on_size( self, window_handle, message, wparam, lparam ):
+        self._client_region = (0, 0,
+                               win32api.LOWORD( lparam ),
+                               win32api.HIWORD( lparam ))
+        return 0
+
     def _on_close( self, window_handle, message, wparam, lparam ):
         self.set_visibility( False )
         return 0
 
     def destroy( self ):
         self.set_systray( None, None )
+        self.invalidate_menu()
         win32gui.DestroyWindow( self.window_handle )
         win32gui.UnregisterClass( self.window_class_name, self.module_handle )
         self.window_handle = None
@@ -883,10 +1178,19 @@ class WinapiGUI(BaseGUI):
         allows us to toggle sensitivity, replace text, etc.
     """
 
-    _variable_re = re.compile( "%\(([\w]+)\)s" )
+    _variable_re = re.compile( r"%\(([\w]+)\)s" )
+
+    # Status display colors: (pattern, lowercase hex digits -> 0-255)
+    _color_patterns = (
+        (re.compile( r'^#([0-9a-fA-F]{2})([0-9a-fA-F]{2})([0-9a-fA-F]{2})$' ), _HEX8),
+        (re.compile( r'^#([0-9a-fA-F])([0-9a-fA-F])([0-9a-fA-F])$' ), _HEX4)
+    )
 
     _progress_range = 1000
 
+    # Number of decoded images open_image keeps around
+    _IMAGE_CACHE_SIZE = 64
+
     # Signal that our Queue should be drained
     #
     WM_USER_QUEUE = win32con.WM_USER + 26
@@ -899,9 +1203,17 @@ class WinapiGUI(BaseGUI):
 
     def _resolve_variables( self, path ):
         '''
-        Apply %(variable) expansion.
+        Apply %(variable) expansion. Variables are fixed for the life of the
+        gui, so expansions are cached.
         '''
-        return self._variable_re.sub( self._lookup_token, path )
+        result = self._resolved_paths.get( path )
+        if result is None:
+            if '%(' in path:
+                result = self._variable_re.sub( self._lookup_token, path )
+            else:
+                result = path
+            self._resolved_paths[ path ] = result
+        return result
 
     def __init__(self, config, variables = {'theme': 'light' } ):
         '''
@@ -909,15 +1221,24 @@ class WinapiGUI(BaseGUI):
         '''
         super(WinapiGUI,self).__init__(config)
         self.variables = variables
+        self._resolved_paths = {}
+        self._image_paths = {}
+        self._image_cache = collections.OrderedDict()
         self.ready = False
         self.statuses = {}
         self.items = {}
+        # (font, label) -> button text extent
+        self._text_extent_cache = {}
+        self._layout_scheduled = False
+        # Held while a WM_USER_QUEUE is posted but not yet handled
+        self._signal_pending = threading.Lock()
 
     def layout_displays( self, padding = 10 ):
         '''
         layout displays top-to-bottom, placing notification text after
 
-        TODO: use 2 passes to split v-spacing
+        Displays are measured once packed together, then shifted down to
+        split the leftover space between them.
         '''
         region = self.main_window.get_client_region()
         region = (region[0] + padding,
@@ -926,13 +1247,11 @@ class WinapiGUI(BaseGUI):
                   min(region[3] - 2 * padding, self.button_region[1]))
 
         hdc = win32gui.GetWindowDC( self.main_window.window_handle )
-        def display_keys():
-            items = self.config['main_window']['status_displays']
-            return [item['id'] for item in items]
 
         rect = region
+        keys = self._display_keys
 
-        for key in display_keys():
+        for key in keys:
             display = self.displays[ key ]
 
             detail_text = display.details.text
@@ -942,24 +1261,14 @@ class WinapiGUI(BaseGUI):
             display.details.set_props( text = detail_text )
 
         if len( self.displays ) > 1:
-            v_spacing = min( (rect[3] - rect[1]) / (len( self.displays ) -1), padding * 2 )
+            v_spacing = min( (rect[3] - rect[1]) // (len( self.displays ) -1), padding * 2 )
         else:
             v_spacing = 0
-        rect = region
 
-        for key in display_keys():
-            display = self.displays[ key ]
-
-            detail_text = display.details.text
-            detail_lines = max( detail_text.count( '\n' ), 2 )
-            display.details.set_props( text = 'placeholder\n' * detail_lines  )
-            rect = display.layout( hdc, rect, padding )
-            display.details.set_props( text = detail_text )
-
-            rect = (rect[0],
-                    rect[1] + v_spacing,
-                    rect[2],
-                    rect[3])
+        # Layout only depends on the top edge, so spacing is just an offset
+        if v_spacing:
+            for index, key in enumerate( keys ):
+                self.displays[ key ].offset( index * v_spacing )
 
         #self.notification_text.rect = rect
         win32gui.ReleaseDC( self.main_window.window_handle, hdc )
@@ -968,9 +1277,6 @@ class WinapiGUI(BaseGUI):
         '''
         layout buttons, assuming the config declaration is in order.
         '''
-        def button_items():
-            button_keys = [item['id'] for item in self.config['main_window']['action_items']]
-            return [self.items[ key ] for key in button_keys]
         window_size = self.main_window.get_client_region()
 
         # Layout left to right across the bottom
@@ -978,18 +1284,31 @@ class WinapiGUI(BaseGUI):
         min_height = 20
         x_offset = window_size[0] + spacing
         y_offset = window_size[3] - window_size[1] - spacing
-        x_limit = window_size[2],
+        x_limit = window_size[2]
         y_min = y_offset
 
-        for index, item in enumerate( button_items() ):
+        items = self._button_items
+
+        # Measure any new labels with one DC, all buttons share a font
+        font = self.fonts['buttons']
+        extents = self._text_extent_cache
+        missing = [ item[ 'action' ].label for item in items
+                    if (font, item[ 'action' ].label) not in extents ]
+        if missing:
+            hdc = win32gui.GetDC( self.main_window.window_handle )
+            prior_font = win32gui.SelectObject( hdc, font )
+            try:
+                for label in missing:
+                    extents[ (font, label) ] = win32gui.GetTextExtentPoint32( hdc, label )
+            finally:
+                win32gui.SelectObject( hdc, prior_font )
+                win32gui.ReleaseDC( self.main_window.window_handle, hdc )
+
+        for index, item in enumerate( items ):
             action = item[ 'action' ]
             button = item[ 'control' ]
 
-            hdc = win32gui.GetDC( button.handle )
-            prior_font = win32gui.SelectObject( hdc, self.fonts['buttons'] )
-            width, height = win32gui.GetTextExtentPoint32( hdc, action.label )
-            win32gui.SelectObject( hdc, prior_font )
-            win32gui.ReleaseDC( None, hdc )
+            width, height = extents[ (font, action.label) ]
 
             width = max( width + padding * 2, min_width )
             height = max( height + padding, min_height )
@@ -1021,10 +1340,13 @@ class WinapiGUI(BaseGUI):
 
         self.notification_text.set_props( self.main_window, rect = notification_rect )
 
-        # Force buttons to refresh overlapped regions
-        for item in button_items():
-            button = item[ 'control' ]
-            win32gui.InvalidateRect( button.handle, None, False )
+        # Force buttons to refresh overlapped regions, all in one go
+        win32gui.RedrawWindow( self.main_window.window_handle,
+                               self.button_region,
+                               None,
+                               win32con.RDW_INVALIDATE |
+                               win32con.RDW_NOERASE |
+                               win32con.RDW_ALLCHILDREN )
 
     def create_action( self, control_factory, item ):
         action = Action( self.proxy or self,
@@ -1067,6 +1389,8 @@ class WinapiGUI(BaseGUI):
         # actions
         for item in self.config['main_window']['action_items']:
             self.create_action( self.create_button_control, item )
+        self._button_items = [ self.items[ item['id'] ]
+                               for item in self.config['main_window']['action_items'] ]
 
         self.layout_buttons()
 
@@ -1086,28 +1410,32 @@ class WinapiGUI(BaseGUI):
         font_config.lfQuality = win32con.CLEARTYPE_QUALITY
         font_config.lfPitchAndFamily = win32con.DEFAULT_PITCH | win32con.FF_DONTCARE
 
-        if family and family not in self.known_fonts:
+        if family and not self._font_exists( hdc, family ):
             print("Unknown font: '{}', using '{}'".format( family, self.default_font ))
+            family = None
 
-        font_config.lfFaceName =  family if family in self.known_fonts else self.default_font
+        font_config.lfFaceName = family or self.default_font
 
         return win32gui.CreateFontIndirect( font_config )
 
-    def create_fonts( self ):
+    @staticmethod
+    def _font_exists( hdc, family ):
         '''
-        Create all font objects
+        Check if a font family is installed, only enumerating that family.
         '''
-        self.known_fonts = {}
+        found = []
         def handle_font( font_config, text_metric, font_type, param ):
-            #print font_config.lfFaceName
-            self.known_fonts[ font_config.lfFaceName ] = font_config
-            return True
+            found.append( font_config.lfFaceName )
+            return False # one match is enough
 
-        hdc = win32gui.GetWindowDC( self.main_window.window_handle )
+        win32gui.EnumFontFamilies( hdc, family, handle_font, None )
+        return bool( found )
 
-        #print "=== begin availalbe fonts ==="
-        win32gui.EnumFontFamilies( hdc, None, handle_font, None )
-        #print "=== end available fonts ==="
+    def create_fonts( self ):
+        '''
+        Create all font objects
+        '''
+        hdc = win32gui.GetWindowDC( self.main_window.window_handle )
 
         # https://stackoverflow.com/questions/6057239/which-font-is-the-default-for-mfc-dialog-controls
         self.non_client_metrics = win32gui.SystemParametersInfo( win32con.SPI_GETNONCLIENTMETRICS, None, 0 )
@@ -1172,11 +1500,29 @@ class WinapiGUI(BaseGUI):
                     rect[2],
                     rect[3])
 
+        def offset( self, dy ):
+            '''
+            Move a laid out display down by dy without measuring it again.
+            '''
+            def shift( rect ):
+                return (rect[0], rect[1] + dy, rect[2], rect[3] + dy)
+
+            for layer in (self.title, self.details):
+                layer.rect = shift( layer.rect )
+                if layer.roi:
+                    layer.roi = shift( layer.roi )
+            self.icon.rect = shift( self.icon.rect )
+            self.rect = (self.rect[0],
+                         self.rect[1] + dy,
+                         self.rect[2] + dy,
+                         self.rect[3])
+
     def create_displays( self ):
         '''
         create status displays and do layout
         '''
         self.displays = { item['id']: self.StatusDisplay( gui = self, **item ) for item in self.config['main_window']['status_displays'] }
+        self._display_keys = [ item['id'] for item in self.config['main_window']['status_displays'] ]
 
         for display in list(self.displays.values()):
             layers = ( display.title, display.details )
@@ -1187,18 +1533,34 @@ class WinapiGUI(BaseGUI):
         '''
         Drain the thread-safe action queue inside winproc for synchrounous gui side-effects
         '''
+        # Clear before draining, so anything queued from here on posts again
+        if self._signal_pending.locked():
+            self._signal_pending.release()
+        # Single consumer, so a non-empty deque always has something to pop
         while self.queue:
-            try:
-                msg = self.queue.get_nowait()
-                msg()
-            except queue.Empty:
-                break
+            function, args, kwargs = self.queue.popleft()
+            function( *args, **kwargs )
+
+    def _schedule_layout( self ):
+        '''
+        Relayout buttons once, after whatever is already queued has run.
+        '''
+        if not self._layout_scheduled:
+            self._layout_scheduled = True
+            self.queue.append( (self._scheduled_layout, (), {}) )
+            self._signal_queue()
+
+    def _scheduled_layout( self ):
+        self._layout_scheduled = False
+        self.layout_buttons()
 
     def _signal_queue( self ):
         '''
         signal that there are actions to process in the queue
         '''
-        win32gui.PostMessage( self.systray_window.window_handle, self.WM_USER_QUEUE, 0, 0 )
+        # Only one WM_USER_QUEUE needs to be in flight, it drains everything
+        if self._signal_pending.acquire( False ):
+            win32gui.PostMessage( self.systray_window.window_handle, self.WM_USER_QUEUE, 0, 0 )
 
     def run( self ):
         '''
@@ -1350,6 +1712,8 @@ class WinapiGUI(BaseGUI):
     def set_item(self, id=None, label=None, sensitive = None):
         action = self.items[id]['action']
         if label:
+            if label != action.label:
+                self._text_extent_cache.pop( (self.fonts['buttons'], action.label), None )
             action.label = label
         if sensitive is not None:
             action.sensitive = sensitive
@@ -1357,7 +1721,10 @@ class WinapiGUI(BaseGUI):
         control = self.items[id]['control']
         if control:
             control.set_action( action )
-            self.layout_buttons()
+            self._schedule_layout()
+        else:
+            # Menu items have no control, they live in the systray menu
+            self.systray_window.invalidate_menu()
 
     def set_status_display(self, id, title=None, details=None, icon=None, color=None):
         display = self.displays[ id ]
@@ -1368,32 +1735,41 @@ class WinapiGUI(BaseGUI):
             display.details.set_props( self.main_window, text = details )
 
         if color is not None:
-
-            def decode( pattern, scale, value ):
-                match = re.match( pattern, value )
-                hexToInt = lambda hex: int( int( hex, 16 ) * scale )
-                return tuple( map( hexToInt, match.groups() ) )
-
-            decoders = [
-                functools.partial( decode, '^#([\w]{2})([\w]{2})([\w]{2})$', 1 ),
-                functools.partial( decode, '^#([\w]{1})([\w]{1})([\w]{1})$', 255.0/15.0 )
-            ]
-
-            for decoder in decoders:
-                try:
-                    rgb = win32api.RGB( *decoder(color) )
-                    display.title.set_props( self.main_window, color = rgb )
-                    display.details.set_props( self.main_window, color = rgb )
-                    break
-                except AttributeError:
-                    pass
+            rgb = self._decode_color( color )
+            if rgb is not None:
+                display.title.set_props( color = rgb )
+                display.details.set_props( color = rgb )
+                # Color doesn't move the text, only repaint what it covers
+                title = display.title.roi or display.title.rect
+                details = display.details.roi or display.details.rect
+                text_rect = (min( title[0], details[0] ),
+                             min( title[1], details[1] ),
+                             max( title[2], details[2] ),
+                             max( title[3], details[3] ))
+                win32gui.InvalidateRect( self.main_window.window_handle,
+                                         text_rect,
+                                         False )
 
         if icon is not None:
             display.icon.source = self.open_image( icon )
             self.compositor.invalidate()
+            # The compositor repaints its background, no need to erase
             win32gui.InvalidateRect( self.main_window.window_handle,
-                                     display.rect,
-                                     True )
+                                     display.icon.rect,
+                                     False )
+
+    def _decode_color( self, color ):
+        '''
+        Parse #rrggbb or #rgb into a winapi color, None if unrecognized.
+        '''
+        for pattern, table in self._color_patterns:
+            match = pattern.match( color )
+            if match is not None:
+                red, green, blue = match.groups()
+                return win32api.RGB( table[ red.lower() ],
+                                     table[ green.lower() ],
+                                     table[ blue.lower() ] )
+        return None
 
     def update_splash_screen(self, message=None, progress=None):
         if progress:
@@ -1406,11 +1782,27 @@ class WinapiGUI(BaseGUI):
 
     def open_image( self, name ):
         if name:
-            return PIL.Image.open( self.get_image_path( name ) )
+            image = self._image_cache.pop( name, None )
+            if image is None:
+                image = PIL.Image.open( self.get_image_path( name ) )
+                image.load()
+                if len( self._image_cache ) >= self._IMAGE_CACHE_SIZE:
+                    self._image_cache.popitem( last = False )
+            self._image_cache[ name ] = image
+            # Callers are free to modify what they get
+            return image.copy()
         else:
-            return PIL.Image.new("RGBA", (1,1), color = (0,0,0,0))
+            # Only ever blended from, so everyone can share it
+            return _EMPTY_IMAGE
 
     def get_image_path( self, name ):
+        # Paths and symlinks don't change under us, only probe each once
+        path = self._image_paths.get( name )
+        if path is None:
+            path = self._image_paths[ name ] = self._find_image_path( name )
+        return path
+
+    def _find_image_path( self, name ):
         prefix = 'image:'
         if name.startswith( prefix ):
             key = name[ len( prefix ): ]
@@ -1447,9 +1839,9 @@ class WinapiGUI(BaseGUI):
             if width and height:
                 pass
             elif height and not width:
-                width = height * image.size[0] / image.size[1]
+                width = height * image.size[0] // image.size[1]
             elif width and not height:
-                height = width * image.size[1] / image.size[0]
+                height = width * image.size[1] // image.size[0]
             else:
                 height = image.size[1]
                 width = image.size[0]
@@ -1557,15 +1949,20 @@ class AsyncWrapper( object ):
         self.touchup = touchup
         self.get_signal = get_signal
 
+        # The external interface is fixed by the class, work it out once
+        self.methods = tuple( attr for attr in dir( cls )
+                              if not attr.startswith( '_' )
+                              and callable( getattr( cls, attr ) ) )
+
     @staticmethod
     def wrap( function, queue, signal ):
         '''
-        Wrap calling functions as async queue messages
+        Wrap calling functions as async queue messages of
+        (function, args, kwargs)
         '''
         @functools.wraps( function )
         def post_message( *args, **kwargs ):
-            msg = functools.partial( function, *args, **kwargs )
-            queue.put( msg )
+            queue.append( (function, args, kwargs) )
             signal()
 
         return post_message
@@ -1577,18 +1974,15 @@ class AsyncWrapper( object ):
         '''
         target = self.cls( *args, **kwargs )
         proxy = self.proxy( *args, **kwargs )
-        queue = queue.Queue()
+        # deque.append/popleft are atomic, which is all the locking we need
+        message_queue = collections.deque()
 
         signal = self.get_signal(target)
 
-        for attr in dir( target ):
-            if attr.startswith('_'):
-                continue
-            value = getattr( target, attr )
-            if callable( value ):
-                setattr( proxy, attr, self.wrap(value ,queue, signal) )
+        for attr in self.methods:
+            setattr( proxy, attr, self.wrap( getattr( target, attr ), message_queue, signal ) )
 
-        self.touchup( target, proxy, queue )
+        self.touchup( target, proxy, message_queue )
         return proxy
 
 def signal_gui( winapi ):
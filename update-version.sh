@@ -6,17 +6,15 @@
 #
 # SPDX-License-Identifier: LGPL-3.0-only
 #
-# This script updates the version numberss in setup.py and
-# gui_o_matic/__init__.py based on the length of the git commit log.
+# This script updates the version number in gui_o_matic/__init__.py (which
+# pyproject.toml reads it from) based on the length of the git commit log.
 
 MAIN_VERSION="0.3"
 VERSION="${MAIN_VERSION}.$((1 + $(git log --pretty=oneline | wc -l)))"
 
-perl -i -npe "s/^VERSION =.*/VERSION = '${VERSION}'/m" setup.py
-
 perl -i -npe "s/^__version__ =.*/__version__ = '${VERSION}'/m" \
   gui_o_matic/__init__.py
 
-git add setup.py gui_o_matic/__init__.py
+git add gui_o_matic/__init__.py
 git commit -m "This is version ${VERSION}"
 git tag -f "${VERSION}"